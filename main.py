@@ -1,24 +1,44 @@
-from queue import Queue
+from array import array
+import math
+import sys
 import time
 from colorama import Fore, Style
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 # Constants
 BIT_RESOLUTION = 20
 MAX_VALUE = (2 ** BIT_RESOLUTION) - 1
 RAM_SIZE = 100
+DEBUG = False
+
+OP_LDA = 0x1
+OP_STA = 0x2
+OP_ADD = 0x3
+OP_SUB = 0x4
+OP_AND = 0x5
+OP_OR  = 0x6
+OP_NOT = 0x7
+OP_XOR = 0x8
+OP_INP = 0x9
+OP_OUT = 0xA
+OP_HLT = 0xB
 
 instructions = {
-    "LDA":      0x1,
-    "STA":      0x2,
-    "ADD":      0x3,
-    "SUB":      0x4,
-    "AND":      0x5,
-    "OR":       0x6,
-    "NOT":      0x7,
-    "XOR":      0x8,
-    "INP":      0x9,
-    "OUT":      0xA,
-    "HLT":      0xB
+    "LDA":      OP_LDA,
+    "STA":      OP_STA,
+    "ADD":      OP_ADD,
+    "SUB":      OP_SUB,
+    "AND":      OP_AND,
+    "OR":       OP_OR,
+    "NOT":      OP_NOT,
+    "XOR":      OP_XOR,
+    "INP":      OP_INP,
+    "OUT":      OP_OUT,
+    "HLT":      OP_HLT
 }
 
 def to_signed(value):
@@ -26,117 +46,157 @@ def to_signed(value):
         value -= (1 << BIT_RESOLUTION)
     return value
 
-def to_unsigned(value):
-    if value < 0:
-        value += (1 << BIT_RESOLUTION)
-    return value & MAX_VALUE
-
-def clock(cu, frequency=1.0):
-    period = 1.0 / frequency
+def clock(cu, frequency=1.0, batch=None):
+    if frequency <= 0:
+        # Run flat out: through the compiled core if numba is installed.
+        # Imported here so timed runs don't pay for it.
+        try:
+            import numba
+        except ImportError:
+            numba = None
+        if numba is not None:
+            cu.run_native(numba.njit(cache=True)(run))
+        cycle = cu.cycle
+        while True:
+            cycle()
+    if batch is None:
+        # Sync (sleep and print) at most ~60 times a second.
+        batch = max(1, math.ceil(frequency / 60))
+    period = batch / frequency
+    cycle = cu.cycle
+    now = time.perf_counter
+    sleep = time.sleep
+    next_tick = now()
     while True:
-        start_time = time.time()
-        cu.fetch()
-        cu.decode()
-        cu.execute()
-        elapsed_time = time.time() - start_time
-        time.sleep(max(0, period - elapsed_time))
+        for _ in range(batch):
+            cycle()
+        prettyprint(cu)
+        next_tick += period
+        sleep_for = next_tick - now()
+        if sleep_for > 0:
+            sleep(sleep_for)
+        elif sleep_for < -period:
+            # Fell more than a tick behind: resync instead of bursting.
+            next_tick = now()
 
 def prettyprint(cu):
-    print(Fore.YELLOW + "PC:" + Style.RESET_ALL, cu.pc.get())
-    print(Fore.YELLOW + "MAR:" + Style.RESET_ALL, cu.mar.get())
-    print(Fore.YELLOW + "MDR:" + Style.RESET_ALL, cu.mdr.get())
-    print(Fore.YELLOW + "CIR:" + Style.RESET_ALL, cu.cir.get())
-    print(Fore.YELLOW + "ACCUMULATOR:" + Style.RESET_ALL, cu.accumulator.get())
-    print(Fore.YELLOW + "RAM:" + Style.RESET_ALL)
-    print(Fore.YELLOW + "Variables:" + Style.RESET_ALL)
+    # Build the whole dump first so each tick costs a single write.
+    lines = [
+        Fore.YELLOW + "PC:" + Style.RESET_ALL + f" {cu.pc.get_signed()}",
+        Fore.YELLOW + "MAR:" + Style.RESET_ALL + f" {cu.mar.get_signed()}",
+        Fore.YELLOW + "MDR:" + Style.RESET_ALL + f" {cu.mdr.get_signed()}",
+        Fore.YELLOW + "CIR:" + Style.RESET_ALL + f" {cu.cir.get_signed()}",
+        Fore.YELLOW + "ACCUMULATOR:" + Style.RESET_ALL + f" {cu.accumulator.get_signed()}",
+        Fore.YELLOW + "RAM:" + Style.RESET_ALL,
+        Fore.YELLOW + "Variables:" + Style.RESET_ALL,
+    ]
     for key, value in cu.variables.items():
-        print(Fore.CYAN + f"{key}:" + Style.RESET_ALL, cu.ram.get(value))
-
-class Bus:
-    def __init__(self):
-        self.data = Queue()
-
-    def read(self):
-        return self.data.get()
-
-    def write(self, value):
-        self.data.put(value)
-
-class Transistor:
-    def __init__(self):
-        self.state = 0
-
-    def get(self):
-        return self.state
-
-    def set(self, state):
-        self.state = state & 1 # either 0 or 1
-    
-    def __str__(self):
-        return str(self.state)
-
-    def __repr__(self):
-        return str(self.state)
+        lines.append(Fore.CYAN + f"{key}:" + Style.RESET_ALL + f" {cu.ram.get_signed(value)}")
+    print("\n".join(lines))
+
+def run(ram, regs, max_cycles):
+    # Fetch/decode/execute loop over plain integers, compiled with numba by
+    # clock() when running at full speed. regs holds PC, MAR, MDR, CIR and ACCUMULATOR (unsigned).
+    # Stops with PC still pointing at any instruction it cannot run itself
+    # (INP, OUT, HLT, invalid opcodes, out-of-range addresses) and returns
+    # True so the caller can step it in Python. Returns False if max_cycles
+    # ran out first.
+    pc = np.int64(regs[0])
+    mar = np.int64(regs[1])
+    mdr = np.int64(regs[2])
+    cir = np.int64(regs[3])
+    acc = np.int64(regs[4])
+    size = ram.shape[0]
+    stopped = False
+    for _ in range(max_cycles):
+        if pc >= size:
+            stopped = True
+            break
+        instruction = np.int64(ram[pc])
+        opcode = (instruction >> 16) & 0xF
+        operand = instruction & 0xFFFF
+        if opcode != OP_NOT and (opcode < OP_LDA or opcode > OP_XOR or operand >= size):
+            stopped = True
+            break
+        mar = pc
+        mdr = instruction
+        cir = instruction
+        pc = (pc + 1) & MAX_VALUE
+        if opcode == OP_LDA:
+            acc = np.int64(ram[operand])
+        elif opcode == OP_STA:
+            ram[operand] = acc
+        elif opcode == OP_ADD:
+            acc = (acc + np.int64(ram[operand])) & MAX_VALUE
+        elif opcode == OP_SUB:
+            acc = (acc - np.int64(ram[operand])) & MAX_VALUE
+        elif opcode == OP_AND:
+            acc = acc & np.int64(ram[operand])
+        elif opcode == OP_OR:
+            acc = acc | np.int64(ram[operand])
+        elif opcode == OP_NOT:
+            acc = acc ^ MAX_VALUE
+        else:
+            acc = acc ^ np.int64(ram[operand])
+    regs[0] = pc
+    regs[1] = mar
+    regs[2] = mdr
+    regs[3] = cir
+    regs[4] = acc
+    return stopped
 
 class Register:
-    def __init__(self, name, bus):
+    __slots__ = ("name", "_value")
+
+    def __init__(self, name):
         self.name = name
-        self.data = [Transistor() for _ in range(BIT_RESOLUTION)]
-        self.bus = bus
+        self._value = 0
 
     def get(self):
-        value = 0
-        for i in range(BIT_RESOLUTION):
-            value |= (self.data[i].get() << i)
-        return to_signed(value)
+        return self._value
 
-    def set(self, value):
-        value = to_unsigned(value)
-        print(f"{Fore.GREEN}Setting {self.name} to {bin(value)}{Fore.RESET}")
-        for i in range(BIT_RESOLUTION):
-            self.data[i].set((value >> i) & 1)
-
-    def read_from_bus(self):
-        self.set(self.bus.read())
+    def get_signed(self):
+        return to_signed(self._value)
 
-    def write_to_bus(self):
-        self.bus.write(self.get())
+    def set(self, value):
+        value = value & MAX_VALUE
+        if DEBUG:
+            print(f"{Fore.GREEN}Setting {self.name} to {bin(value)}{Fore.RESET}")
+        self._value = value
 
 class RAM:
-    def __init__(self, bus):
+    __slots__ = ("cells",)
+
+    def __init__(self):
         print(f"Initializing RAM of size {RAM_SIZE}")
-        self.cells = [[Transistor() for _ in range(BIT_RESOLUTION)] for _ in range(RAM_SIZE)]
-        self.bus = bus
+        if np is not None:
+            self.cells = np.zeros(RAM_SIZE, dtype=np.uint32)
+        else:
+            self.cells = array("I", [0] * RAM_SIZE)
         print(f"{Fore.GREEN}RAM of size {RAM_SIZE} initialized.{Fore.RESET}")
 
     def get(self, address):
-        value = 0
-        for i in range(BIT_RESOLUTION):
-            value |= (self.cells[address][i].get() << i)
-        return to_signed(value)
+        return int(self.cells[address])
+
+    def get_signed(self, address):
+        return to_signed(int(self.cells[address]))
     
     def set(self, address, value):
-        value = to_unsigned(value)
-        for i in range(BIT_RESOLUTION):
-            self.cells[address][i].set((value >> i) & 1)
-
-    def read_from_bus(self):
-        address = self.bus.read()
-        self.bus.write(self.get(address))
+        self.cells[address] = value & MAX_VALUE
 
-    def write_to_bus(self):
-        address = self.bus.read()
-        value = self.bus.read()
-        self.set(address, value)
+    def load(self, words):
+        if len(words) > RAM_SIZE:
+            raise IndexError("RAM index out of range")
+        self.cells[:len(words)] = array("I", words)
 
 class ALU:
     @staticmethod
     def add(val1, val2):
-        return to_signed((to_unsigned(val1) + to_unsigned(val2)) & MAX_VALUE)
+        return (val1 + val2) & MAX_VALUE
 
     @staticmethod
     def sub(val1, val2):
-        return to_signed((to_unsigned(val1) - to_unsigned(val2)) & MAX_VALUE)
+        return (val1 - val2) & MAX_VALUE
 
     @staticmethod
     def and_(val1, val2):
@@ -148,123 +208,203 @@ class ALU:
 
     @staticmethod
     def not_(val1):
-        return to_signed(~to_unsigned(val1))
+        return (~val1) & MAX_VALUE
     
     @staticmethod
     def xor_(val1, val2):
         return val1 ^ val2
 
 class CU:
+    __slots__ = (
+        "pc", "mar", "mdr", "cir", "accumulator", "ram",
+        "variables",
+        "_dispatch", "threaded",
+    )
+
     def __init__(self):
-        self.bus = Bus()
-        self.pc = Register("PC", self.bus)
-        self.mar = Register("MAR", self.bus)
-        self.mdr = Register("MDR", self.bus)
-        self.cir = Register("CIR", self.bus)
-        self.accumulator = Register("ACCUMULATOR", self.bus)
-        self.ram = RAM(self.bus)
-        self.alu = ALU()
+        self.pc = Register("PC")
+        self.mar = Register("MAR")
+        self.mdr = Register("MDR")
+        self.cir = Register("CIR")
+        self.accumulator = Register("ACCUMULATOR")
+        self.ram = RAM()
 
         self.variables = {}
-        self.next_variable_address = RAM_SIZE-1
-
-        self.pipeline_fetch = None
-        self.pipeline_decode = None
-
-    def fetch(self):
-        self.mar.set(self.pc.get())
-        self.bus.write(self.mar.get())
-        self.ram.read_from_bus()
-        self.mdr.read_from_bus()
-        self.pc.set(self.pc.get()+1)
-        self.pipeline_fetch = self.mdr.get()
-
-    def decode(self):
-        if self.pipeline_fetch is not None:
-            instruction = self.pipeline_fetch
-            opcode = (instruction >> 16) & 0xF
-            operand = instruction & 0xFFFF
-            self.pipeline_decode = (opcode, operand)
-            self.pipeline_fetch = None
-
-    def execute(self):
-        if self.pipeline_decode is not None:
-            opcode, operand = self.pipeline_decode
-            if opcode == instructions["LDA"]:
-                self.bus.write(operand)
-                self.ram.read_from_bus()
-                self.accumulator.read_from_bus()
-            elif opcode == instructions["STA"]:
-                self.bus.write(operand)
-                self.bus.write(self.accumulator.get())
-                self.ram.write_to_bus()
-            elif opcode == instructions["ADD"]:
-                self.bus.write(operand)
-                self.ram.read_from_bus()
-                self.accumulator.set(self.alu.add(self.accumulator.get(), self.bus.read()))
-            elif opcode == instructions["SUB"]:
-                self.bus.write(operand)
-                self.ram.read_from_bus()
-                self.accumulator.set(self.alu.sub(self.accumulator.get(), self.bus.read()))
-            elif opcode == instructions["AND"]:
-                self.bus.write(operand)
-                self.ram.read_from_bus()
-                self.accumulator.set(self.alu.and_(self.accumulator.get(), self.bus.read()))
-            elif opcode == instructions["OR"]:
-                self.bus.write(operand)
-                self.ram.read_from_bus()
-                self.accumulator.set(self.alu.or_(self.accumulator.get(), self.bus.read()))
-            elif opcode == instructions["NOT"]:
-                self.accumulator.set(self.alu.not_(self.accumulator.get()))
-            elif opcode == instructions["XOR"]:
-                self.bus.write(operand)
-                self.ram.read_from_bus()
-                self.accumulator.set(self.alu.xor_(self.accumulator.get(), self.bus.read()))
-            elif opcode == instructions["INP"]:
-                self.accumulator.set(int(input()))
-            elif opcode == instructions["OUT"]:
-                print("OUT:", self.accumulator.get())
-            elif opcode == instructions["HLT"]:
-                exit("Halt")
-            else:
-                raise ValueError(f"Invalid opcode")
-            self.pipeline_decode = None
-        prettyprint(self)
 
-def main():
+        self._dispatch = [None] * 16
+        self._dispatch[OP_LDA] = self._op_lda
+        self._dispatch[OP_STA] = self._op_sta
+        self._dispatch[OP_ADD] = self._op_add
+        self._dispatch[OP_SUB] = self._op_sub
+        self._dispatch[OP_AND] = self._op_and
+        self._dispatch[OP_OR] = self._op_or
+        self._dispatch[OP_NOT] = self._op_not
+        self._dispatch[OP_XOR] = self._op_xor
+        self._dispatch[OP_INP] = self._op_inp
+        self._dispatch[OP_OUT] = self._op_out
+        self._dispatch[OP_HLT] = self._op_hlt
+        for i in range(16):
+            if self._dispatch[i] is None:
+                self._dispatch[i] = self._op_invalid
+
+        self.threaded = []
+
+    def build_threaded(self, program):
+        # Pre-decode each program word into a (handler, operand, word) triple
+        # so the hot path skips fetch/decode. The raw word is kept for MDR and CIR.
+        dispatch = self._dispatch
+        self.threaded = [
+            (dispatch[(instruction >> 16) & 0xF], instruction & 0xFFFF, instruction)
+            for instruction in program
+        ]
+
+    def cycle(self):
+        pc = self.pc._value
+        threaded = self.threaded
+        if pc < len(threaded) and threaded[pc] is not None:
+            handler, operand, instruction = threaded[pc]
+            if DEBUG:
+                self.mar.set(pc)
+                self.mdr.set(instruction)
+                self.cir.set(instruction)
+                self.pc.set(pc + 1)
+            else:
+                self.mar._value = pc
+                self.mdr._value = instruction
+                self.cir._value = instruction
+                self.pc._value = (pc + 1) & MAX_VALUE
+            handler(operand)
+        else:
+            self.step()
+
+    def step(self):
+        # fetch, decode and execute fused into one call. Updates the same
+        # registers as the threaded path in cycle() and the compiled run().
+        mar = self.pc._value
+        instruction = int(self.ram.cells[mar])
+        if DEBUG:
+            self.mar.set(mar)
+            self.mdr.set(instruction)
+            self.cir.set(instruction)
+            self.pc.set(mar + 1)
+        else:
+            self.mar._value = mar
+            self.mdr._value = instruction
+            self.cir._value = instruction
+            self.pc._value = (mar + 1) & MAX_VALUE
+        self._dispatch[(instruction >> 16) & 0xF](instruction & 0xFFFF)
+
+    def run_native(self, core, max_cycles=1 << 20):
+        regs = np.zeros(5, dtype=np.uint32)
+        registers = (self.pc, self.mar, self.mdr, self.cir, self.accumulator)
+        while True:
+            for i, register in enumerate(registers):
+                regs[i] = register._value
+            stopped = core(self.ram.cells, regs, max_cycles)
+            for i, register in enumerate(registers):
+                register._value = int(regs[i])
+            if stopped:
+                # I/O, HLT and errors go through the regular Python path.
+                self.step()
+
+    def _op_lda(self, operand):
+        self.accumulator.set(self.ram.get(operand))
+
+    def _op_sta(self, operand):
+        self.ram.set(operand, self.accumulator.get())
+        threaded = self.threaded
+        if operand < len(threaded):
+            # Self-modifying code: drop the stale pre-decoded slot.
+            threaded[operand] = None
+
+    def _op_add(self, operand):
+        accumulator = self.accumulator
+        accumulator.set(ALU.add(accumulator.get(), self.ram.get(operand)))
+
+    def _op_sub(self, operand):
+        accumulator = self.accumulator
+        accumulator.set(ALU.sub(accumulator.get(), self.ram.get(operand)))
+
+    def _op_and(self, operand):
+        accumulator = self.accumulator
+        accumulator.set(ALU.and_(accumulator.get(), self.ram.get(operand)))
+
+    def _op_or(self, operand):
+        accumulator = self.accumulator
+        accumulator.set(ALU.or_(accumulator.get(), self.ram.get(operand)))
+
+    def _op_not(self, operand):
+        accumulator = self.accumulator
+        accumulator.set(ALU.not_(accumulator.get()))
+
+    def _op_xor(self, operand):
+        accumulator = self.accumulator
+        accumulator.set(ALU.xor_(accumulator.get(), self.ram.get(operand)))
+
+    def _op_inp(self, operand):
+        self.accumulator.set(int(input()))
+
+    def _op_out(self, operand):
+        print("OUT:", self.accumulator.get_signed())
+
+    def _op_hlt(self, operand):
+        exit("Halt")
+
+    def _op_invalid(self, operand):
+        raise ValueError(f"Invalid opcode")
+
+def assemble(lines):
+    # Returns the program words, the variable name -> address map and the
+    # DAT values keyed by address. Variables are allocated downwards from the
+    # top of RAM.
     program = []
-    x = ""
-    cu = CU()
+    variables = {}
+    data = {}
+    next_variable_address = RAM_SIZE-1
 
-    while x != "end":
-        x = input().split(" ")
-        if x[0] == "end":
-            break
-    
+    for line in lines:
+        x = line.split(" ")
         if x[0] == "DAT":
-            cu.variables[x[1]] = cu.next_variable_address
-            cu.ram.set(cu.next_variable_address, int(x[2]))
-            cu.next_variable_address -= 1
+            variables[x[1]] = next_variable_address
+            data[next_variable_address] = int(x[2])
+            next_variable_address -= 1
         else:
             if len(x) > 1:
-                if x[1].isalnum():
-                    program.append(
-                        (instructions[x[0]] << 16) | (cu.variables[x[1]] & 0xFFFF)
-                    )
-                else:
-                    program.append(
-                        (instructions[x[0]] << 16) | (int(x[1]) & 0xFFFF)
-                    )
+                try:
+                    operand = variables[x[1]]
+                except KeyError:
+                    operand = int(x[1])
+                program.append(
+                    (instructions[x[0]] << 16) | (operand & 0xFFFF)
+                )
             else:
                 program.append(
                     (instructions[x[0]] << 16)
                 )
 
-    for i in range(len(program)):
-        cu.ram.set(i, program[i])
-        print(f"{bin(cu.ram.get(i))}")
+    return program, variables, data
+
+def main():
+    lines = []
+    cu = CU()
+
+    while True:
+        line = input()
+        if line.split(" ")[0] == "end":
+            break
+        lines.append(line)
+
+    program, cu.variables, data = assemble(lines)
+    for address, value in data.items():
+        cu.ram.set(address, value)
+    cu.ram.load(program)
+
+    word_format = f"0{BIT_RESOLUTION}b"
+    print("\n".join(format(int(cu.ram.cells[i]), word_format) for i in range(len(program))))
+    cu.build_threaded(program)
 
-    clock(cu)
+    frequency = float(sys.argv[1]) if len(sys.argv) > 1 else 1.0
+    clock(cu, frequency)
 
 if __name__ == '__main__':
     main()